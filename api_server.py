@@ -7,25 +7,37 @@ using the CSV index to fetch the corresponding row and generate the view.
 """
 
 import os
+import re
 import warnings
-import time
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Suppress multiprocessing resource tracker warnings (common on macOS)
-os.environ['PYTHONWARNINGS'] = 'ignore::UserWarning:multiprocessing.resource_tracker'
 warnings.filterwarnings('ignore', category=UserWarning, module='multiprocessing.resource_tracker')
 
 from flask import Flask, jsonify, send_file, request
 from flask_cors import CORS
+from flask_compress import Compress
+from cachetools import LRUCache
 import pandas as pd
-import aiohttp
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.feather as feather
+import numpy as np
 from pathlib import Path
 import logging
 import io
-import base64
-import json
+from urllib.parse import quote
+import hashlib
+import gzip
+import brotli
+import orjson
 from panorama_fetcher import PanoramaFetcher
 from mask_processor import MaskProcessor
+from utils import evict_pano_cache
+
+# Copy-on-Write makes filtered frames cheap views until they are mutated
+pd.options.mode.copy_on_write = True
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -35,23 +47,313 @@ app = Flask(__name__)
 # Enable CORS for all routes to allow requests from GitHub Pages
 CORS(app)
 
+# Compress dynamic JSON responses (pre-serialized payloads ship precompressed)
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_BR_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 2048
+Compress(app)
+
 # Global variables to store data
 csv_data = None
+CSV_VERSION = None  # (st_mtime_ns, st_size) of the loaded CSV
 panorama_fetcher = None
 mask_processor = None
 
+# Pre-serialized map payloads (the CSVs never change at runtime)
+TREE_DATA_BYTES = None
+TREE_DATA_ETAG = None
+TREE_DATA_COMPRESSED = None
+STREETVIEW_DATA_BYTES = None
+STREETVIEW_DATA_ETAG = None
+STREETVIEW_DATA_COMPRESSED = None
+
+# Rows shown on the map, filtered once at startup
+FILTERED_TREES = None
+
+# Per-column NumPy arrays for O(1) /api/tree-info lookups
+TREE_COLUMNS = None
+CSV_LEN = 0
+
+# pano_id -> positional indices of that panorama's rows, for O(1) per-pano slicing
+TREE_ROWS_BY_PANO = {}
+
+# Rendered panorama JPEGs keyed by their ETag (see panorama_etag), in memory and on
+# disk. Zoom-5 renders are several MB each, so both tiers are bounded by bytes.
+PANORAMA_CACHE = LRUCache(maxsize=256 * 1024 * 1024, getsizeof=len)
+PANORAMA_CACHE_LOCK = threading.Lock()
+PANORAMA_CACHE_DIR = Path("data/panorama_cache")
+PANORAMA_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Part of every panorama ETag; bump it whenever the rendering output changes so
+# stale renders on disk and in browsers are not reused
+PANORAMA_RENDER_VERSION = 1
+
+# Parsed CSV tables as Arrow IPC files, reused until the source CSV changes
+CSV_CACHE_DIR = Path("cache/csv")
+
+# Raw mask JSON bytes and ETag keyed by pano_id, bounded by total size. The mask
+# corpus is several hundred MB, so files are cached on first use, not preloaded.
+MASK_BYTES = LRUCache(maxsize=128 * 1024 * 1024, getsizeof=lambda entry: len(entry[0]))
+MASK_BYTES_LOCK = threading.Lock()
+
 # Thread pool for parallel processing
 THREAD_POOL = ThreadPoolExecutor(max_workers=4)
 
+# Upper bound on pano_ids accepted by /api/panorama/batch
+MAX_BATCH_PANORAMAS = 16
+
+# Street View pano_ids; anything else (e.g. "/" or "..") could escape the mask
+# and panorama cache directories the id is joined into
+PANO_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+# Columns read from the tree CSV (the model-estimate columns are never served)
+TREE_CSV_COLUMNS = [
+    'image_path', 'pano_id', 'stview_lat', 'stview_lng', 'tree_lat', 'tree_lng',
+    'image_x', 'image_y', 'theta', 'conf', 'distance_pano'
+]
+
+# Columns returned per tree by /api/tree-data (csv_index is added from the index)
+TREE_DATA_COLUMNS = [
+    'tree_lat', 'tree_lng', 'pano_id', 'image_x', 'image_y', 'conf',
+    'distance_pano', 'stview_lat', 'stview_lng', 'theta', 'image_path'
+]
+
+# /api/tree-info response field -> CSV column
+TREE_INFO_FIELDS = {
+    'pano_id': 'pano_id',
+    'tree_lat': 'tree_lat',
+    'tree_lng': 'tree_lng',
+    'stview_lat': 'stview_lat',
+    'stview_lng': 'stview_lng',
+    'image_x': 'image_x',
+    'image_y': 'image_y',
+    'theta': 'theta',
+    'confidence': 'conf',
+    'distance': 'distance_pano'
+}
+
+def orjson_response(payload):
+    """Serialize payload with orjson and wrap it in a JSON response."""
+    return app.response_class(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        mimetype='application/json'
+    )
+
+def encode_jpeg(image, quality=90):
+    """
+    Encode a PIL image as JPEG into a rewound in-memory buffer.
+    
+    Uses 4:2:0 chroma subsampling and progressive scans, so the browser can
+    render a coarse panorama before the whole body has arrived.
+    """
+    image_buffer = io.BytesIO()
+    image.save(image_buffer, format='JPEG', quality=quality, subsampling=2,
+               optimize=False, progressive=True)
+    image_buffer.seek(0)
+    return image_buffer
+
+def panorama_response(image, etag, cache_status):
+    """
+    Send a rendered panorama JPEG (buffer or file path) with caching headers.
+    
+    send_file sets Content-Length and honours Range requests for both kinds of
+    input.
+    """
+    response = send_file(
+        image,
+        mimetype='image/jpeg',
+        as_attachment=False,
+        etag=etag,
+        conditional=True,
+        max_age=0
+    )
+    set_panorama_cache_headers(response)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+def set_panorama_cache_headers(response):
+    """
+    Let clients keep panoramas but revalidate them on every use.
+    
+    The URL stays the same when masks, the CSV or the renderer change, so the
+    ETag (not the URL) carries the version and a 304 is the cheap common case.
+    """
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+
+def remember_panorama(cache_key, image_bytes):
+    """Put a rendered panorama in the memory LRU (skipping bodies larger than its budget)."""
+    if len(image_bytes) > PANORAMA_CACHE.maxsize:
+        return
+    with PANORAMA_CACHE_LOCK:
+        PANORAMA_CACHE[cache_key] = image_bytes
+
+def store_cached_panorama(cache_key, etag, image_bytes):
+    """Keep a rendered panorama in the memory LRU and write it to the disk cache."""
+    remember_panorama(cache_key, image_bytes)
+    try:
+        PANORAMA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path = PANORAMA_CACHE_DIR / f"{etag}.jpg"
+        tmp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(image_bytes)
+        os.replace(tmp_path, cache_path)
+        evict_pano_cache(PANORAMA_CACHE_DIR, PANORAMA_CACHE_MAX_BYTES)
+    except OSError as e:
+        logger.warning(f"⚠️ Could not write panorama cache file for {cache_key[0]}: {e}")
+
+def cached_json_response(payload_bytes, etag, compressed=None):
+    """
+    Serve pre-serialized JSON bytes, answering 304 when the ETag matches.
+    
+    Args:
+        payload_bytes: Uncompressed JSON body
+        etag: ETag of the uncompressed body
+        compressed: Optional mapping of content-coding -> precompressed body;
+                    the first one the client accepts is sent instead
+    """
+    body, encoding = payload_bytes, None
+    for coding in (compressed or {}):
+        if coding in request.accept_encodings:
+            body, encoding = compressed[coding], coding
+            break
+    
+    response = app.response_class(body, mimetype='application/json')
+    if compressed:
+        response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+        etag = f"{etag}-{encoding}"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+def compress_payload(payload_bytes):
+    """Precompress a cached payload once, preferred content-coding first."""
+    # Moderate levels: this runs at import time on the full tree payload, and
+    # start.sh gives the server a few seconds to start listening
+    return {
+        'br': brotli.compress(payload_bytes, quality=4),
+        'gzip': gzip.compress(payload_bytes, compresslevel=6)
+    }
+
+def serialize_payload(payload):
+    """Serialize payload once and return (bytes, etag) for caching."""
+    payload_bytes = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    etag = hashlib.blake2b(payload_bytes, digest_size=16).hexdigest()
+    return payload_bytes, etag
+
+def filter_map_trees(data):
+    """Select the trees shown on the map (near their panorama, with coordinates)."""
+    mask = (
+        (data['distance_pano'] < 12) &
+        data[['distance_pano', 'tree_lat', 'tree_lng', 'pano_id']].notna().all(axis=1)
+    )
+    return data.loc[mask]
+
+def build_tree_records(filtered_data):
+    """Convert the filtered tree rows to JSON-ready records for the map."""
+    # Convert whole columns at once instead of row by row (NaN -> None)
+    records = filtered_data[TREE_DATA_COLUMNS].astype(object)
+    records = records.where(filtered_data[TREE_DATA_COLUMNS].notna(), None)
+    records.insert(3, 'csv_index', filtered_data.index.astype(int))  # Original CSV index
+    return records.to_dict(orient='records')
+
+def build_tree_columns(data):
+    """Materialize the /api/tree-info columns as contiguous NumPy arrays."""
+    columns = {}
+    for column in TREE_INFO_FIELDS.values():
+        if column == 'pano_id':
+            # Missing ids become None, matching the records payload
+            pano_ids = data[column].astype(object)
+            columns[column] = pano_ids.where(pano_ids.notna(), None).to_numpy()
+        else:
+            columns[column] = data[column].to_numpy(dtype='float64', na_value=np.nan)
+    return columns
+
+def read_csv_arrow(csv_path, columns, column_types=None):
+    """
+    Read a CSV with Arrow's multithreaded reader into an Arrow-backed DataFrame.
+    
+    Args:
+        csv_path: Path to the CSV file
+        columns: Columns to read (all others are skipped while parsing)
+        column_types: Optional column -> Arrow type overrides
+        
+    Returns:
+        DataFrame with ArrowDtype columns; dictionary columns become categoricals
+    """
+    # One cache file per (CSV, column selection, type overrides)
+    cache_key = hashlib.blake2b(repr((columns, column_types)).encode(), digest_size=8).hexdigest()
+    cache_path = CSV_CACHE_DIR / f"{Path(csv_path).stem}-{cache_key}.arrow"
+    
+    table = None
+    try:
+        if cache_path.stat().st_mtime_ns >= os.stat(csv_path).st_mtime_ns:
+            table = feather.read_table(cache_path, memory_map=True)
+            logger.info(f"⚡ Loaded {csv_path} from Arrow cache {cache_path}")
+    except (OSError, pa.ArrowInvalid):
+        table = None
+    
+    if table is None:
+        table = pv.read_csv(
+            csv_path,
+            read_options=pv.ReadOptions(use_threads=True, block_size=8 << 20),
+            convert_options=pv.ConvertOptions(column_types=column_types or {}, include_columns=columns)
+        )
+        try:
+            CSV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            feather.write_feather(table, tmp_path, compression='uncompressed')
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not write Arrow cache for {csv_path}: {e}")
+    
+    return table.to_pandas(
+        types_mapper=lambda arrow_type: None if pa.types.is_dictionary(arrow_type) else pd.ArrowDtype(arrow_type)
+    )
+
 def load_csv_data():
-    """Load the CSV data once at startup."""
-    global csv_data
+    """Load the CSV data once at startup and cache the /api/tree-data payload."""
+    global csv_data, CSV_VERSION, FILTERED_TREES, TREE_COLUMNS, CSV_LEN, TREE_ROWS_BY_PANO
+    global TREE_DATA_BYTES, TREE_DATA_ETAG, TREE_DATA_COMPRESSED
     csv_path = "public/south_delhi_trees.csv"
     logger.info(f"Loading CSV data from {csv_path}")
-    csv_data = pd.read_csv(csv_path)
-    logger.info(f"Loaded {len(csv_data)} rows from CSV")
+    csv_stat = os.stat(csv_path)
+    CSV_VERSION = (csv_stat.st_mtime_ns, csv_stat.st_size)
+    csv_data = read_csv_arrow(
+        csv_path, TREE_CSV_COLUMNS,
+        column_types={'pano_id': pa.dictionary(pa.int32(), pa.string())}
+    )
+    CSV_LEN = len(csv_data)
+    logger.info(f"Loaded {CSV_LEN} rows from CSV")
+
+    FILTERED_TREES = filter_map_trees(csv_data)
+    tree_records = build_tree_records(FILTERED_TREES)
+    TREE_DATA_BYTES, TREE_DATA_ETAG = serialize_payload(tree_records)
+    TREE_DATA_COMPRESSED = compress_payload(TREE_DATA_BYTES)
+    logger.info(f"📊 Cached {len(tree_records)} tree records (filtered from {len(csv_data)} total)")
+
+    TREE_COLUMNS = build_tree_columns(csv_data)
+    TREE_ROWS_BY_PANO = csv_data.groupby('pano_id', sort=False, observed=True).indices
     return csv_data
 
+def load_streetview_data():
+    """Load the street view CSV once at startup and cache the /api/streetview-data payload."""
+    global STREETVIEW_DATA_BYTES, STREETVIEW_DATA_ETAG, STREETVIEW_DATA_COMPRESSED
+    sv_path = "public/south_delhi_panoramas.csv"
+    logger.info(f"Loading street view data from {sv_path}")
+    sv_data = read_csv_arrow(sv_path, ['lat', 'lng', 'pano_id'])
+
+    filtered_data = sv_data[
+        (sv_data['lat'].notna()) &
+        (sv_data['lng'].notna()) &
+        (sv_data['pano_id'].notna())
+    ]
+    sv_records = filtered_data[['lat', 'lng', 'pano_id']].to_dict(orient='records')
+    STREETVIEW_DATA_BYTES, STREETVIEW_DATA_ETAG = serialize_payload(sv_records)
+    STREETVIEW_DATA_COMPRESSED = compress_payload(STREETVIEW_DATA_BYTES)
+    logger.info(f"📍 Cached {len(sv_records)} street view records")
+    return sv_data
+
 def initialize_processors():
     """Initialize the panorama fetcher and mask processor."""
     global panorama_fetcher, mask_processor
@@ -79,32 +381,19 @@ def get_tree_info(csv_index):
     """
     try:
         # Validate index
-        if csv_data is None:
+        if csv_data is None or TREE_COLUMNS is None:
             return jsonify({"error": "CSV data not loaded"}), 500
         
-        if csv_index < 0 or csv_index >= len(csv_data):
+        # Flask's <int:...> converter never yields negatives, so one compare suffices
+        if csv_index >= CSV_LEN:
             return jsonify({"error": f"Invalid CSV index: {csv_index}"}), 400
         
-        # Get the row from CSV
-        row = csv_data.iloc[csv_index]
-        
-        # Return tree information
-        response = {
-            "success": True,
-            "csv_index": csv_index,
-            "pano_id": row['pano_id'],
-            "tree_lat": float(row['tree_lat']),
-            "tree_lng": float(row['tree_lng']),
-            "stview_lat": float(row['stview_lat']),
-            "stview_lng": float(row['stview_lng']),
-            "image_x": float(row['image_x']),
-            "image_y": float(row['image_y']),
-            "theta": float(row['theta']),
-            "confidence": float(row['conf']),
-            "distance": float(row['distance_pano']) if 'distance_pano' in row else None
-        }
+        # Return tree information straight from the column arrays
+        response = {"success": True, "csv_index": csv_index}
+        for field, column in TREE_INFO_FIELDS.items():
+            response[field] = TREE_COLUMNS[column][csv_index]
         
-        return jsonify(response)
+        return orjson_response(response)
         
     except Exception as e:
         logger.error(f"Error getting tree info for index {csv_index}: {str(e)}")
@@ -112,40 +401,12 @@ def get_tree_info(csv_index):
 
 @app.route('/api/tree-data', methods=['GET'])
 def get_tree_data():
-    """Get preprocessed tree data for the map (optimized for large datasets)."""
+    """Get preprocessed tree data for the map (served from the startup cache)."""
     try:
-        if csv_data is None:
+        if TREE_DATA_BYTES is None:
             return jsonify({"error": "CSV data not loaded"}), 500
         
-        # Filter and convert data efficiently using pandas
-        filtered_data = csv_data[
-            (csv_data['distance_pano'] < 12) & 
-            (csv_data['distance_pano'].notna()) &
-            (csv_data['tree_lat'].notna()) &
-            (csv_data['tree_lng'].notna()) &
-            (csv_data['pano_id'].notna())
-        ].copy()
-        
-        # Convert to optimized format
-        result = []
-        for idx, (_, row) in enumerate(filtered_data.iterrows()):
-            result.append({
-                "tree_lat": float(row['tree_lat']),
-                "tree_lng": float(row['tree_lng']),
-                "pano_id": str(row['pano_id']),
-                "csv_index": int(row.name),  # Original CSV index
-                "image_x": float(row['image_x']) if pd.notna(row['image_x']) else None,
-                "image_y": float(row['image_y']) if pd.notna(row['image_y']) else None,
-                "conf": float(row['conf']) if pd.notna(row['conf']) else None,
-                "distance_pano": float(row['distance_pano']) if pd.notna(row['distance_pano']) else None,
-                "stview_lat": float(row['stview_lat']) if pd.notna(row['stview_lat']) else None,
-                "stview_lng": float(row['stview_lng']) if pd.notna(row['stview_lng']) else None,
-                "theta": float(row['theta']) if pd.notna(row['theta']) else None,
-                "image_path": str(row['image_path']) if pd.notna(row['image_path']) else None
-            })
-        
-        logger.info(f"📊 Returning {len(result)} tree records (filtered from {len(csv_data)} total)")
-        return jsonify(result)
+        return cached_json_response(TREE_DATA_BYTES, TREE_DATA_ETAG, TREE_DATA_COMPRESSED)
         
     except Exception as e:
         logger.error(f"Error getting tree data: {str(e)}")
@@ -153,34 +414,94 @@ def get_tree_data():
 
 @app.route('/api/streetview-data', methods=['GET'])
 def get_streetview_data():
-    """Get preprocessed street view data for the map."""
+    """Get preprocessed street view data for the map (served from the startup cache)."""
     try:
-        # Load street view data
-        sv_path = "public/south_delhi_panoramas.csv"
-        sv_data = pd.read_csv(sv_path)
-        
-        # Filter and convert data efficiently
-        filtered_data = sv_data[
-            (sv_data['lat'].notna()) &
-            (sv_data['lng'].notna()) &
-            (sv_data['pano_id'].notna())
-        ].copy()
+        if STREETVIEW_DATA_BYTES is None:
+            return jsonify({"error": "Street view data not loaded"}), 500
         
-        result = []
-        for _, row in filtered_data.iterrows():
-            result.append({
-                "lat": float(row['lat']),
-                "lng": float(row['lng']),
-                "pano_id": str(row['pano_id'])
-            })
-        
-        logger.info(f"📍 Returning {len(result)} street view records")
-        return jsonify(result)
+        return cached_json_response(STREETVIEW_DATA_BYTES, STREETVIEW_DATA_ETAG,
+                                    STREETVIEW_DATA_COMPRESSED)
         
     except Exception as e:
         logger.error(f"Error getting street view data: {str(e)}")
         return jsonify({"error": "Failed to get street view data"}), 500
 
+def panorama_etag(pano_id, clicked_image_path=None):
+    """
+    Compute the ETag (and cache key) of a rendered panorama.
+    
+    The rendered image is deterministic per (pano_id, highlighted tree) for a
+    given mask file, CSV and renderer, so their versions are hashed in too.
+    """
+    try:
+        mask_stat = mask_processor.mask_file_path(pano_id).stat()
+        mask_version = (mask_stat.st_mtime_ns, mask_stat.st_size)
+    except FileNotFoundError:
+        mask_version = None
+    key = (PANORAMA_RENDER_VERSION, CSV_VERSION, mask_version, pano_id, clicked_image_path or '')
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+
+def render_panorama(pano_id, clicked_image_path=None):
+    """
+    Produce the masked panorama JPEG for pano_id, using the caches when possible.
+    
+    Args:
+        pano_id: Panorama ID to render
+        clicked_image_path: Image path of the tree to highlight, if any
+        
+    Returns:
+        Tuple of (source, etag, cache_status) where source is a BytesIO, or
+        None if the panorama could not be fetched
+    """
+    etag = panorama_etag(pano_id, clicked_image_path)
+    cache_key = (pano_id, etag)
+    
+    with PANORAMA_CACHE_LOCK:
+        image_bytes = PANORAMA_CACHE.get(cache_key)
+    if image_bytes is not None:
+        return io.BytesIO(image_bytes), etag, 'HIT'
+    
+    # Read disk hits in full (a concurrent sweep may unlink the file) and touch
+    # them so the sweep evicts least recently used renders first
+    cache_path = PANORAMA_CACHE_DIR / f"{etag}.jpg"
+    try:
+        image_bytes = cache_path.read_bytes()
+    except FileNotFoundError:
+        image_bytes = None
+    if image_bytes is not None:
+        try:
+            os.utime(cache_path)
+        except FileNotFoundError:
+            pass
+        remember_panorama(cache_key, image_bytes)
+        return io.BytesIO(image_bytes), etag, 'HIT'
+    
+    logger.info(f"🖼️ Fetching panorama with masks for pano_id: {pano_id}")
+    if clicked_image_path:
+        logger.info(f"🎯 Highlighting clicked tree: {clicked_image_path}")
+    
+    # Fetch the panorama using the fetcher
+    panorama_image = panorama_fetcher.fetch_panorama_sync(pano_id)
+    
+    if panorama_image is None:
+        return None, etag, None
+    
+    # Load and apply mask data
+    mask_data = mask_processor.load_mask_data(pano_id)
+    if mask_data:
+        logger.info(f"🎭 Applying mask data for {pano_id}")
+        pano_rows = csv_data.iloc[TREE_ROWS_BY_PANO.get(pano_id, np.empty(0, dtype=np.intp))]
+        panorama_image = mask_processor.apply_masks_to_panorama(
+            panorama_image, mask_data, pano_rows, clicked_image_path
+        )
+    else:
+        logger.info(f"⚠️ No mask data found for {pano_id}")
+    
+    # Encode the final image straight into the buffer that is sent
+    image_buffer = encode_jpeg(panorama_image)
+    store_cached_panorama(cache_key, etag, image_buffer.getvalue())
+    return image_buffer, etag, 'MISS'
+
 @app.route('/api/panorama/<pano_id>', methods=['GET'])
 def get_panorama(pano_id):
     """
@@ -199,42 +520,81 @@ def get_panorama(pano_id):
         # Get the clicked tree info from query parameters
         clicked_image_path = request.args.get('image_path')
         
-        logger.info(f"🖼️ Fetching panorama with masks for pano_id: {pano_id}")
-        if clicked_image_path:
-            logger.info(f"🎯 Highlighting clicked tree: {clicked_image_path}")
+        # Revalidations of an unchanged render skip the caches entirely
+        etag = panorama_etag(pano_id, clicked_image_path)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            set_panorama_cache_headers(response)
+            return response
         
-        # Fetch the panorama using the fetcher
-        panorama_image = panorama_fetcher.fetch_panorama_sync(pano_id)
-        
-        if panorama_image is None:
+        image_source, etag, cache_status = render_panorama(pano_id, clicked_image_path)
+        if image_source is None:
             return jsonify({"error": "Failed to fetch panorama"}), 500
         
-        # Load and apply mask data
-        mask_data = mask_processor.load_mask_data(pano_id)
-        if mask_data:
-            logger.info(f"🎭 Applying mask data for {pano_id}")
-            panorama_image = mask_processor.apply_masks_to_panorama(
-                panorama_image, mask_data, csv_data, clicked_image_path
-            )
-        else:
-            logger.info(f"⚠️ No mask data found for {pano_id}")
-        
-        # Save the final image
-        image_buffer = io.BytesIO()
-        panorama_image.save(image_buffer, format='JPEG', quality=95)
-        image_bytes = image_buffer.getvalue()
-        
         # Return the image
-        return send_file(
-            io.BytesIO(image_bytes),
-            mimetype='image/jpeg',
-            as_attachment=False
-        )
+        return panorama_response(image_source, etag, cache_status)
         
     except Exception as e:
         logger.error(f"Error fetching panorama: {str(e)}")
         return jsonify({"error": "Failed to fetch panorama"}), 500
 
+@app.route('/api/panorama/batch', methods=['POST'])
+def get_panorama_batch():
+    """
+    Fetch several masked panoramas in one request.
+    
+    Expects a JSON list of pano_ids, renders them into the panorama cache and
+    streams NDJSON back, one {"pano_id": ..., "image_url": ...} line per
+    panorama in completion order, so slow fetches don't hold back fast ones.
+    The client then loads each JPEG from image_url as a cache hit. Ids that are
+    not plain Street View pano_ids get an error line and are never fetched.
+    
+    Returns:
+        application/x-ndjson stream or error message
+    """
+    try:
+        if panorama_fetcher is None or mask_processor is None or csv_data is None:
+            return jsonify({"error": "Processors or CSV data not initialized"}), 500
+        
+        pano_ids = request.get_json(silent=True)
+        if not isinstance(pano_ids, list) or not all(isinstance(p, str) for p in pano_ids):
+            return jsonify({"error": "Expected a JSON list of pano_ids"}), 400
+        
+        pano_ids = list(dict.fromkeys(pano_ids))
+        if len(pano_ids) > MAX_BATCH_PANORAMAS:
+            return jsonify({"error": f"At most {MAX_BATCH_PANORAMAS} pano_ids per batch"}), 400
+        
+        invalid_ids = [pano_id for pano_id in pano_ids if not PANO_ID_PATTERN.fullmatch(pano_id)]
+        valid_ids = [pano_id for pano_id in pano_ids if PANO_ID_PATTERN.fullmatch(pano_id)]
+        
+        logger.info(f"📦 Fetching batch of {len(valid_ids)} panoramas")
+        futures = {THREAD_POOL.submit(render_panorama, pano_id): pano_id for pano_id in valid_ids}
+        
+        def stream_ndjson():
+            for pano_id in invalid_ids:
+                yield orjson.dumps({"pano_id": pano_id, "error": "Invalid pano_id"}) + b"\n"
+            
+            for future in as_completed(futures):
+                pano_id = futures[future]
+                try:
+                    image_source = future.result()[0]
+                except Exception as e:
+                    logger.error(f"Error fetching panorama {pano_id} in batch: {str(e)}")
+                    image_source = None
+                
+                if image_source is None:
+                    line = {"pano_id": pano_id, "error": "Failed to fetch panorama"}
+                else:
+                    line = {"pano_id": pano_id, "image_url": f"/api/panorama/{quote(pano_id, safe='')}"}
+                yield orjson.dumps(line) + b"\n"
+        
+        return app.response_class(stream_ndjson(), mimetype='application/x-ndjson')
+        
+    except Exception as e:
+        logger.error(f"Error fetching panorama batch: {str(e)}")
+        return jsonify({"error": "Failed to fetch panorama batch"}), 500
+
 @app.route('/api/mask-data/<pano_id>', methods=['GET'])
 def get_mask_data(pano_id):
     """
@@ -249,19 +609,27 @@ def get_mask_data(pano_id):
     try:
         logger.info(f"🎭 Fetching mask data for pano_id: {pano_id}")
         
-        # Construct the mask file path
-        mask_file_path = Path("masks") / f"{pano_id}_masks.json"
-        
-        if not mask_file_path.exists():
-            logger.warning(f"⚠️ Mask file not found: {mask_file_path}")
-            return jsonify({"error": "Mask data not found"}), 404
+        with MASK_BYTES_LOCK:
+            cached_mask = MASK_BYTES.get(pano_id)
         
-        # Read and return the mask data
-        with open(mask_file_path, 'r') as f:
-            mask_data = json.load(f)
+        if cached_mask is None:
+            # Construct the mask file path
+            mask_file_path = Path("masks") / f"{pano_id}_masks.json"
+            
+            if not mask_file_path.exists():
+                logger.warning(f"⚠️ Mask file not found: {mask_file_path}")
+                return jsonify({"error": "Mask data not found"}), 404
+            
+            # The file is already the JSON we serve, so keep the raw bytes
+            file_stat = mask_file_path.stat()
+            cached_mask = (mask_file_path.read_bytes(), f"{file_stat.st_mtime_ns}-{file_stat.st_size}")
+            with MASK_BYTES_LOCK:
+                MASK_BYTES[pano_id] = cached_mask
         
-        logger.info(f"✅ Successfully loaded mask data for {pano_id}")
-        return jsonify(mask_data)
+        mask_bytes, etag = cached_mask
+        response = cached_json_response(mask_bytes, etag)
+        response.cache_control.max_age = 3600
+        return response
         
     except Exception as e:
         logger.error(f"Error fetching mask data: {str(e)}")
@@ -270,6 +638,7 @@ def get_mask_data(pano_id):
 if __name__ == '__main__':
     # Initialize data and processors
     load_csv_data()
+    load_streetview_data()
     initialize_processors()
     
     # Create output directory for API-generated views
@@ -284,6 +653,7 @@ if __name__ == '__main__':
     print("="*60)
     print("\nAPI Endpoints:")
     print("  GET /api/tree-info/<csv_index> - Get tree information")
+    print("  POST /api/panorama/batch - Fetch several panoramas as NDJSON")
     print("  GET /health - Health check")
     print("="*60 + "\n")
     
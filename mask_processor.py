@@ -7,25 +7,77 @@ mask application to panoramas, and coordinate transformations.
 """
 
 import cv2
+import hashlib
 import numpy as np
-import json
+import numba
+import orjson
 import logging
+import threading
 from pathlib import Path
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Union
 from PIL import Image
 import pycocotools.mask as maskUtils
-from utils import map_perspective_point_to_original
+from cachetools import LRUCache
+from utils import map_perspective_points_to_original
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Mask fill color (RGB) and opacity used for tree overlays
+MASK_FILL_COLOR = np.array([0.0, 255.0, 0.0])
+MASK_FILL_ALPHA = 0.05
+
+# Marks a polygon cache miss (None is a valid cached result for empty masks)
+_MISSING = object()
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _blend(image_u8, mask_u8, color, alpha):
+    """
+    Alpha-blend a solid color into an image wherever the mask is set (in place).
+    
+    Blending is done in 8.8 fixed point, so pixels never leave integer math.
+    
+    Args:
+        image_u8: (H, W, C) uint8 image region to blend into
+        mask_u8: (H, W) uint8 mask, non-zero where the color is applied
+        color: Per-channel color values
+        alpha: Opacity of the color
+    """
+    height, width = mask_u8.shape
+    channels = image_u8.shape[2]
+    
+    # Integer weights out of 256, with the color term and rounding folded in
+    weight = int(alpha * 256.0 + 0.5)
+    keep = 256 - weight
+    offset = np.empty(channels, np.int64)
+    for c in range(channels):
+        offset[c] = int(color[c] + 0.5) * weight + 128
+    
+    for y in numba.prange(height):
+        for x in range(width):
+            if mask_u8[y, x]:
+                for c in range(channels):
+                    image_u8[y, x, c] = (np.int64(image_u8[y, x, c]) * keep + offset[c]) >> 8
+
+
 class MaskProcessor:
     """Handles all mask processing operations."""
     
     def __init__(self):
-        """Initialize the mask processor."""
-        pass
+        """Initialize the mask processor and JIT-compile the blend kernel."""
+        # Decoded mask outlines keyed by (RLE counts digest, size). Counts strings run to
+        # several KB, so keys hold a 16-byte digest; each entry is then a few hundred bytes
+        self._polygon_cache = LRUCache(maxsize=16384)
+        self._polygon_cache_lock = threading.Lock()
+        
+        # Warm up on a contiguous image and on a strided view (the layout ROI
+        # slices have) so the first panorama request doesn't pay the compile cost
+        _blend(np.zeros((2, 2, 3), np.uint8), np.ones((2, 2), np.uint8),
+               MASK_FILL_COLOR, MASK_FILL_ALPHA)
+        _blend(np.zeros((2, 4, 3), np.uint8)[:, :2], np.ones((2, 2), np.uint8),
+               MASK_FILL_COLOR, MASK_FILL_ALPHA)
     
     def decode_rle_mask(self, rle_data: Dict, shape: Tuple[int, int]) -> Optional[np.ndarray]:
         """
@@ -39,7 +91,14 @@ class MaskProcessor:
             Binary mask as numpy array or None if failed
         """
         try:
-            # Use pycocotools to decode RLE mask
+            counts = rle_data['counts']
+            if isinstance(counts, list):
+                # Uncompressed COCO RLE: column-major runs alternating 0/1, starting with 0
+                values = np.arange(len(counts), dtype=np.uint8) & 1
+                binary_mask = np.repeat(values, counts).reshape(rle_data.get('size', shape), order='F')
+                return binary_mask
+            
+            # Use pycocotools to decode compressed RLE mask
             rle = rle_data.copy()
             if isinstance(rle['counts'], str):
                 rle['counts'] = rle['counts'].encode('utf-8')
@@ -52,10 +111,55 @@ class MaskProcessor:
             logger.error(f"Error decoding RLE mask: {e}")
             return None
     
+    def extract_polygon(self, binary_mask: np.ndarray,
+                        bbox: Optional[Tuple[int, int, int, int]] = None) -> Optional[np.ndarray]:
+        """
+        Trace the simplified outline of the largest blob in a binary mask.
+        
+        Args:
+            binary_mask: (H, W) uint8 mask
+            bbox: Optional (x, y, w, h) of the set pixels, if already known
+            
+        Returns:
+            (N, 2) float32 polygon vertices in mask coordinates or None
+        """
+        # Trace contours only inside the mask's bounding box
+        if bbox is None:
+            rows = np.flatnonzero(binary_mask.any(axis=1))
+            cols = np.flatnonzero(binary_mask.any(axis=0))
+            if rows.size == 0:
+                return None
+            y0, y1 = rows[0], rows[-1] + 1
+            x0, x1 = cols[0], cols[-1] + 1
+        else:
+            x0, y0, w, h = bbox
+            x1, y1 = x0 + w, y0 + h
+        roi = np.ascontiguousarray(binary_mask[y0:y1, x0:x1])
+        
+        # Find contours to get polygon coordinates
+        contours, _ = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                       offset=(int(x0), int(y0)))
+        if not contours:
+            return None
+        
+        # Get the largest contour
+        largest_contour = max(contours, key=cv2.contourArea)
+        
+        # Simplify the outline (Douglas-Peucker) so fewer vertices need mapping
+        epsilon = 0.005 * cv2.arcLength(largest_contour, True)
+        largest_contour = cv2.approxPolyDP(largest_contour, epsilon, True)
+        polygon = largest_contour.squeeze().astype(np.float32)
+        if polygon.ndim == 2 and polygon.shape[0] > 2:
+            return polygon
+        return None
+    
     def deserialize_mask(self, mask_data_obj: Dict) -> Optional[Dict]:
         """
         Deserialize mask data from JSON.
         
+        Polygons are memoized by RLE content, so a panorama rendered again
+        (e.g. with another tree highlighted) skips decoding and contour tracing.
+        
         Args:
             mask_data_obj: Mask data object from JSON
             
@@ -64,19 +168,45 @@ class MaskProcessor:
         """
         try:
             if mask_data_obj.get("encoding") == "rle" and mask_data_obj.get("rle"):
-                # Use the existing decode_rle_mask method
-                binary_mask = self.decode_rle_mask(mask_data_obj["rle"], mask_data_obj.get("orig_shape", (720, 1024)))
+                rle = mask_data_obj["rle"]
+                shape = mask_data_obj.get("orig_shape", (720, 1024))
+                counts = rle["counts"]
+                if isinstance(counts, list):
+                    counts_bytes = orjson.dumps(counts)
+                elif isinstance(counts, str):
+                    counts_bytes = counts.encode()
+                else:
+                    counts_bytes = counts
+                cache_key = (hashlib.blake2b(counts_bytes, digest_size=16).digest(),
+                             tuple(rle.get("size", shape)))
                 
-                if binary_mask is not None:
-                    # Find contours to get polygon coordinates
-                    contours, _ = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+                with self._polygon_cache_lock:
+                    cached = self._polygon_cache.get(cache_key, _MISSING)
+                if cached is _MISSING:
+                    bbox = None
+                    if not isinstance(counts, list):
+                        # Bounding box straight from the compressed RLE; empty masks
+                        # are rejected without materializing the dense mask
+                        bbox = tuple(int(v) for v in maskUtils.toBbox(
+                            dict(rle, counts=counts.encode('utf-8') if isinstance(counts, str) else counts)
+                        ))
                     
-                    if contours:
-                        # Get the largest contour
-                        largest_contour = max(contours, key=cv2.contourArea)
-                        polygon = largest_contour.squeeze().astype(np.float32)
-                        if polygon.ndim == 2 and polygon.shape[0] > 2:
-                            return {"xy": [polygon]}
+                    if bbox is not None and (bbox[2] == 0 or bbox[3] == 0):
+                        cached = None
+                    else:
+                        # Use the existing decode_rle_mask method
+                        binary_mask = self.decode_rle_mask(rle, shape)
+                        if binary_mask is None:
+                            return None
+                        cached = self.extract_polygon(binary_mask, bbox)
+                    if cached is not None:
+                        # Shared between renders, so never handed out writable
+                        cached.flags.writeable = False
+                    with self._polygon_cache_lock:
+                        self._polygon_cache[cache_key] = cached
+                
+                if cached is not None:
+                    return {"xy": [cached]}
             
             return None
             
@@ -84,118 +214,151 @@ class MaskProcessor:
             logger.warning(f"⚠️ Error deserializing mask: {str(e)}")
             return None
     
-    def plot_single_mask_on_panorama(self, mask_info: Dict, panorama_image: np.ndarray, 
-                                   theta: float, panorama_width: int, panorama_height: int,
-                                   highlight: bool = False) -> np.ndarray:
+    def blend_polygons(self, panorama_image: np.ndarray, polygons: List[np.ndarray]) -> None:
+        """
+        Blend the mask fill color into the panorama inside polygons (in place).
+        
+        Polygons whose bounding boxes overlap are grouped and rasterized together
+        into a mask covering just that group's box, so overlaps are blended once
+        and pixels between masks spread around the panorama are never touched.
+        
+        Args:
+            panorama_image: Panorama image array, modified in place
+            polygons: (N, 2) int32 polygon vertex arrays in panorama coordinates
+        """
+        panorama_height, panorama_width = panorama_image.shape[:2]
+        
+        # [x0, y0, x1, y1, polygons] per group, merged until no two boxes overlap
+        groups = []
+        for points_array in polygons:
+            x, y, w, h = cv2.boundingRect(points_array)
+            groups.append([x, y, x + w, y + h, [points_array]])
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(groups)):
+                for j in range(i + 1, len(groups)):
+                    a, b = groups[i], groups[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        groups[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                     max(a[2], b[2]), max(a[3], b[3]), a[4] + b[4]]
+                        del groups[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        
+        for x0, y0, x1, y1, group in groups:
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, panorama_width), min(y1, panorama_height)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            
+            # Rasterize the group into a single-channel mask covering just its ROI
+            roi_mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+            offset = np.array([x0, y0], np.int32)
+            cv2.fillPoly(roi_mask, [points_array - offset for points_array in group], 1)
+            _blend(panorama_image[y0:y1, x0:x1], roi_mask, MASK_FILL_COLOR, MASK_FILL_ALPHA)
+    
+    def project_mask_polygon(self, mask_info: Dict, theta: float,
+                             panorama_width: int, panorama_height: int) -> Optional[np.ndarray]:
         """
-        Plot a single mask on panorama image.
+        Decode a mask and project its outline into panorama coordinates.
         
         Args:
             mask_info: Mask information from JSON
-            panorama_image: Panorama image array
             theta: Theta angle for coordinate mapping
             panorama_width, panorama_height: Panorama dimensions
-            highlight: Whether to highlight this mask (for clicked trees)
             
         Returns:
-            Panorama with mask overlay
+            (N, 2) int32 polygon vertices in panorama coordinates or None
         """
-        try:
-            # Create a copy of the panorama for mask overlay
-            panorama_with_mask = panorama_image.copy()
-            img_shape = (panorama_width, panorama_height)
-            
-            # Deserialize mask
-            mask_data_obj = mask_info["mask_data"]
-            deserialized_mask = self.deserialize_mask(mask_data_obj)
-            
-            if deserialized_mask and deserialized_mask.get("xy"):
-                mask_points = deserialized_mask["xy"][0]
-                
-                # Convert perspective coordinates to panorama coordinates
-                panorama_points = []
-                for point in mask_points:
-                    panorama_point = map_perspective_point_to_original(
-                        point[0], point[1], theta, img_shape, 
-                        720, 1024, 90  # height, width, FOV
-                    )
-                    panorama_point = tuple(map(int, panorama_point))
-                    panorama_points.append(panorama_point)
-                
-                # Draw mask on panorama
-                if len(panorama_points) > 2:
-                    points_array = np.array(panorama_points, np.int32)
-                    
-                    if highlight:
-                        # Draw filled polygon with very light overlay
-                        overlay = panorama_with_mask.copy()
-                        cv2.fillPoly(overlay, [points_array], (0, 255, 0))
-                        cv2.addWeighted(overlay, 0.05, panorama_with_mask, 0.95, 0, panorama_with_mask)
-                        
-                        # Draw outline
-                        cv2.polylines(panorama_with_mask, [points_array], 
-                                    isClosed=True, color=(0, 255, 0), thickness=3)
-                        
-                        # Draw bounding box in bright red
-                        x_coords = [p[0] for p in panorama_points]
-                        y_coords = [p[1] for p in panorama_points]
-                        x1, x2 = min(x_coords), max(x_coords)
-                        y1, y2 = min(y_coords), max(y_coords)
-                        cv2.rectangle(panorama_with_mask, (x1, y1), (x2, y2), (0, 0, 255), 4)
-                        
-                        # Draw center point in bright red
-                        center_x = (x1 + x2) // 2
-                        center_y = (y1 + y2) // 2
-                        cv2.circle(panorama_with_mask, (center_x, center_y), 12, (0, 0, 255), -1)
-                        cv2.circle(panorama_with_mask, (center_x, center_y), 16, (255, 255, 255), 3)
-                    else:
-                        # Draw filled polygon with very light overlay for other trees
-                        overlay = panorama_with_mask.copy()
-                        cv2.fillPoly(overlay, [points_array], (0, 255, 0))
-                        cv2.addWeighted(overlay, 0.05, panorama_with_mask, 0.95, 0, panorama_with_mask)
-                        
-                        # Draw outline
-                        cv2.polylines(panorama_with_mask, [points_array], 
-                                    isClosed=True, color=(0, 255, 0), thickness=2)
+        img_shape = (panorama_width, panorama_height)
+        
+        # Deserialize mask
+        mask_data_obj = mask_info["mask_data"]
+        deserialized_mask = self.deserialize_mask(mask_data_obj)
+        
+        if not deserialized_mask or not deserialized_mask.get("xy"):
+            return None
+        
+        mask_points = deserialized_mask["xy"][0]
+        
+        # Convert perspective coordinates to panorama coordinates (all vertices at once)
+        points_array = map_perspective_points_to_original(
+            mask_points, theta, img_shape,
+            720, 1024, 90  # height, width, FOV
+        ).astype(np.int32)
+        
+        if len(points_array) <= 2:
+            return None
+        return points_array
+    
+    def draw_mask_outline(self, panorama_image: np.ndarray, points_array: np.ndarray,
+                          highlight: bool = False) -> None:
+        """
+        Draw a mask outline (and the highlight box for clicked trees) in place.
+        
+        Args:
+            panorama_image: Panorama image array, modified in place
+            points_array: (N, 2) int32 polygon vertices in panorama coordinates
+            highlight: Whether to highlight this mask (for clicked trees)
+        """
+        if highlight:
+            # Draw outline
+            cv2.polylines(panorama_image, [points_array], 
+                        isClosed=True, color=(0, 255, 0), thickness=3)
             
-            return panorama_with_mask
+            # Draw bounding box in bright red
+            x1, y1 = points_array.min(axis=0).tolist()
+            x2, y2 = points_array.max(axis=0).tolist()
+            cv2.rectangle(panorama_image, (x1, y1), (x2, y2), (0, 0, 255), 4)
             
-        except Exception as e:
-            logger.error(f"❌ Error plotting mask: {str(e)}")
-            return panorama_image
+            # Draw center point in bright red
+            center_x = (x1 + x2) // 2
+            center_y = (y1 + y2) // 2
+            cv2.circle(panorama_image, (center_x, center_y), 12, (0, 0, 255), -1)
+            cv2.circle(panorama_image, (center_x, center_y), 16, (255, 255, 255), 3)
+        else:
+            # Draw outline
+            cv2.polylines(panorama_image, [points_array], 
+                        isClosed=True, color=(0, 255, 0), thickness=2)
     
-    def apply_masks_to_panorama(self, panorama_image: Image.Image, mask_data: Dict, 
-                               csv_data, clicked_image_path: Optional[str] = None) -> Image.Image:
+    def apply_masks_to_panorama(self, panorama_image: Union[Image.Image, np.ndarray], mask_data: Dict, 
+                               csv_data, clicked_image_path: Optional[str] = None) -> Union[Image.Image, np.ndarray]:
         """
         Apply mask overlays to panorama image using proper coordinate transformation.
         
+        All polygon fills are rasterized into one mask and blended in a single
+        pass, then the outlines are drawn on top. Arrays are drawn on in place;
+        a PIL image is only converted (and copied) when a mask actually lands on it.
+        
         Args:
-            panorama_image: PIL Image of the panorama
+            panorama_image: PIL Image or RGB uint8 array of the panorama
             mask_data: Mask data from JSON file
-            csv_data: CSV data for validation
+            csv_data: CSV rows for validation (only this panorama's rows are needed)
             clicked_image_path: Path of the clicked tree to highlight with bounding box
             
         Returns:
-            PIL Image with masks applied
+            Panorama with masks applied, of the same type as panorama_image
         """
         try:
-            # Convert PIL to numpy array for processing
-            panorama_array = np.array(panorama_image)
-            panorama_with_masks = panorama_array.copy()
+            is_array = isinstance(panorama_image, np.ndarray)
             
             # Get panorama dimensions
-            panorama_height, panorama_width = panorama_array.shape[:2]
-            img_shape = (panorama_width, panorama_height)
+            if is_array:
+                panorama_height, panorama_width = panorama_image.shape[:2]
+            else:
+                panorama_width, panorama_height = panorama_image.size
             
-            # Create lookup for CSV entries
+            # Create lookup for CSV entries (theta is all that's needed per row)
             csv_lookup = {}
-            for _, row in csv_data.iterrows():
-                key = f"{row['pano_id']}_{row['image_path']}"
-                csv_lookup[key] = row
+            for pano_id, image_path, theta in zip(csv_data['pano_id'], csv_data['image_path'],
+                                                  csv_data['theta']):
+                csv_lookup[f"{pano_id}_{image_path}"] = theta
             
-            masks_applied = 0
-            
-            # Process all views in the mask data
+            # Project every mask that has a CSV entry
+            polygons = []
             for view_key, trees in mask_data['views'].items():
                 for tree in trees:
                     # Check if this mask has a corresponding CSV entry
@@ -204,27 +367,49 @@ class MaskProcessor:
                         logger.debug(f"Skipping mask {tree['tree_index']} - no CSV entry found")
                         continue
                     
-                    csv_entry = csv_lookup[csv_key]
-                    theta = csv_entry.get('theta', 0)  # Get theta from CSV
+                    theta = csv_lookup[csv_key]  # Get theta from CSV
                     
                     # Check if this is the clicked tree
-                    is_clicked_tree = (clicked_image_path and tree['image_path'] == clicked_image_path)
-                    
-                    # Apply the mask
-                    panorama_with_masks = self.plot_single_mask_on_panorama(
-                        tree, panorama_with_masks, theta, panorama_width, panorama_height, 
-                        highlight=is_clicked_tree
-                    )
+                    is_clicked_tree = bool(clicked_image_path and tree['image_path'] == clicked_image_path)
                     
-                    masks_applied += 1
+                    try:
+                        points_array = self.project_mask_polygon(tree, theta, panorama_width, panorama_height)
+                    except Exception as e:
+                        logger.error(f"❌ Error plotting mask: {str(e)}")
+                        continue
+                    if points_array is not None:
+                        polygons.append((points_array, is_clicked_tree))
+            
+            if not polygons:
+                logger.info("Applied 0 masks to panorama")
+                return panorama_image
             
-            logger.info(f"Applied {masks_applied} masks to panorama")
-            return Image.fromarray(panorama_with_masks)
+            # Convert PIL to numpy array for drawing (np.array already copies)
+            panorama_with_masks = panorama_image if is_array else np.array(panorama_image)
+            
+            # Blend each cluster of masks once, touching only its bounding box
+            self.blend_polygons(panorama_with_masks, [points_array for points_array, _ in polygons])
+            
+            # Plain outlines in one polylines call, highlighted trees drawn on top
+            outlines = [points_array for points_array, is_clicked_tree in polygons if not is_clicked_tree]
+            if outlines:
+                cv2.polylines(panorama_with_masks, outlines,
+                              isClosed=True, color=(0, 255, 0), thickness=2)
+            for points_array, is_clicked_tree in polygons:
+                if is_clicked_tree:
+                    self.draw_mask_outline(panorama_with_masks, points_array, highlight=True)
+            
+            logger.info(f"Applied {len(polygons)} masks to panorama")
+            return panorama_with_masks if is_array else Image.fromarray(panorama_with_masks)
             
         except Exception as e:
             logger.error(f"Error applying masks: {e}")
             return panorama_image
     
+    def mask_file_path(self, pano_id: str) -> Path:
+        """Path of the mask JSON file for a panorama ID."""
+        return Path("masks") / f"{pano_id}_masks.json"
+    
     def load_mask_data(self, pano_id: str) -> Optional[Dict]:
         """
         Load mask data for a given panorama ID.
@@ -236,11 +421,9 @@ class MaskProcessor:
             Mask data dictionary or None if not found
         """
         try:
-            mask_file_path = Path("masks") / f"{pano_id}_masks.json"
+            mask_file_path = self.mask_file_path(pano_id)
             if mask_file_path.exists():
-                with open(mask_file_path, 'r') as f:
-                    mask_data = json.load(f)
-                return mask_data
+                return orjson.loads(mask_file_path.read_bytes())
             return None
         except Exception as e:
             logger.error(f"Error loading mask data for {pano_id}: {e}")
@@ -7,21 +7,43 @@ Street View API calls and image processing.
 """
 
 import asyncio
+import functools
+import threading
 import aiohttp
+import requests
 import numpy as np
 import cv2
 import logging
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, List, Mapping, Tuple
 from PIL import Image
 import pandas as pd
 from pathlib import Path
 
-from utils import fetch_pano_by_id, get_perspective
+from utils import fetch_pano_by_id, get_perspective_maps, load_cached_pano, store_cached_pano
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=32)
+def _cached_perspective_maps(theta: float, FOV: int, view_height: int, view_width: int,
+                             panorama_height: int, panorama_width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build (and memoize) fixed-point cv2.remap maps for one view geometry.
+    
+    Views are always 1024x720 at 90° and panoramas of one zoom level share a
+    size, so the sample grid only varies with the exact theta; repeat views of
+    a tree reuse their maps. The maps are converted to CV_16SC2 to keep each
+    cache entry around 4 MB and speed up remap. cv2.remap already resolves
+    float maps to 1/32 px for INTER_CUBIC, so the conversion does not change
+    the output.
+    """
+    map_x, map_y = get_perspective_maps(
+        FOV, theta, 0,  # PHI = 0 (no vertical tilt)
+        view_height, view_width, panorama_height, panorama_width,
+    )
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
 class PanoramaFetcher:
     """Handles all panorama fetching operations."""
     
@@ -33,6 +55,27 @@ class PanoramaFetcher:
             max_concurrent: Maximum number of concurrent panorama fetches
         """
         self.max_concurrent = max_concurrent
+        
+        # One HTTP session per thread (requests.Session is not thread-safe), so
+        # each worker reuses its keep-alive connections instead of rebuilding them
+        self._local = threading.local()
+    
+    def _get_session(self) -> requests.Session:
+        """
+        Get the calling thread's HTTP session, creating it on first use.
+        
+        Returns:
+            requests Session owned by the current thread
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_concurrent,
+                                                    pool_maxsize=self.max_concurrent)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+        return session
     
     def calculate_centered_theta(self, image_x: float, panorama_width: int) -> float:
         """
@@ -77,16 +120,50 @@ class PanoramaFetcher:
             perspective_view: Generated perspective view
         """
         # Calculate theta angle to center the view on image_x
-        theta = self.calculate_centered_theta(image_x, panorama_width)
+        theta = float(self.calculate_centered_theta(image_x, panorama_width))
         
-        # Create perspective view using existing unwrap function
-        perspective_view = get_perspective(
-            panorama_image, FOV, theta, 0,  # PHI = 0 (no vertical tilt)
-            view_height, view_width, panorama_height, panorama_width,
+        # Create perspective view from the cached remap tables
+        map1, map2 = _cached_perspective_maps(
+            theta, FOV, view_height, view_width, panorama_height, panorama_width
+        )
+        perspective_view = cv2.remap(
+            panorama_image, map1, map2, cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP
         )
         
         return perspective_view
     
+    def downsample_for_view(self, panorama_image: np.ndarray, view_width: int,
+                            FOV: int) -> Tuple[np.ndarray, float]:
+        """
+        Halve the panorama resolution while it oversamples the target view by 2x or more.
+        
+        Args:
+            panorama_image: Full panorama image array
+            view_width: Width of the perspective view that will be extracted
+            FOV: Field of view in degrees
+            
+        Returns:
+            Tuple of (panorama_image, scale) where scale maps original panorama
+            coordinates to the returned image
+        """
+        scale = 1.0
+        panorama_height, panorama_width = panorama_image.shape[:2]
+        
+        # The view spans FOV/360 of the panorama width, so this many source
+        # pixels land on each view pixel
+        while panorama_width > 2 * view_width * (360 / FOV):
+            panorama_width //= 2
+            panorama_height //= 2
+            scale /= 2
+        
+        if scale == 1.0:
+            return panorama_image, scale
+        
+        logger.debug(f"📉 Downsampling panorama to {panorama_width}x{panorama_height} for view")
+        resized = cv2.resize(panorama_image, (panorama_width, panorama_height),
+                             interpolation=cv2.INTER_AREA)
+        return resized, scale
+    
     async def fetch_panorama_async(self, pano_id: str, session: aiohttp.ClientSession) -> Tuple[Optional[Any], Optional[np.ndarray]]:
         """
         Fetch panorama data asynchronously.
@@ -100,6 +177,50 @@ class PanoramaFetcher:
         """
         return await fetch_pano_by_id(pano_id, session)
     
+    async def _fetch_view_panorama(self, pano_id: str, session: aiohttp.ClientSession,
+                                   view_width: int, FOV: int) -> Tuple[Optional[Any], Optional[np.ndarray], float]:
+        """Fetch a panorama and downsample it for views of the given width and FOV."""
+        pano, panorama_image = await self.fetch_panorama_async(pano_id, session)
+        if pano is None or panorama_image is None:
+            return pano, panorama_image, 1.0
+        
+        panorama_image, scale = await asyncio.to_thread(
+            self.downsample_for_view, panorama_image, view_width, FOV
+        )
+        return pano, panorama_image, scale
+    
+    async def fetch_view_panorama_async(self, pano_id: str, session: aiohttp.ClientSession,
+                                        view_width: int, FOV: int,
+                                        pano_tasks: Optional[Dict[Tuple[str, int, int], asyncio.Task]] = None
+                                        ) -> Tuple[Optional[Any], Optional[np.ndarray], float]:
+        """
+        Fetch a panorama already downsampled for extracting views.
+        
+        Rows that pass the same pano_tasks dict (one per generate_many call)
+        share one fetch-and-downsample task per panorama, so the download and
+        the resize both happen once. The tasks belong to the caller's event loop.
+        
+        Args:
+            pano_id: Panorama ID to fetch
+            session: aiohttp ClientSession for HTTP requests
+            view_width: Width of the perspective views that will be extracted
+            FOV: Field of view in degrees
+            pano_tasks: Optional batch-local dict of shared fetch tasks
+            
+        Returns:
+            Tuple of (panorama_metadata, panorama_image_array, scale) where scale
+            maps original panorama coordinates to the returned image
+        """
+        if pano_tasks is None:
+            return await self._fetch_view_panorama(pano_id, session, view_width, FOV)
+        
+        key = (pano_id, view_width, FOV)
+        task = pano_tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_view_panorama(pano_id, session, view_width, FOV))
+            pano_tasks[key] = task
+        return await task
+    
     def fetch_panorama_sync(self, pano_id: str) -> Optional[Image.Image]:
         """
         Fetch the original panorama image for a given pano_id using streetlevel (synchronous).
@@ -110,49 +231,61 @@ class PanoramaFetcher:
         Returns:
             Panorama image as PIL Image or None if failed
         """
+        # Same on-disk LRU cache (and key) as the async fetch path
+        cached = load_cached_pano(pano_id)
+        if cached is not None:
+            return Image.fromarray(cached[1])
+        
         try:
             from streetlevel import streetview
             
             # Use streetlevel to find and download the panorama
-            pano = streetview.find_panorama_by_id(pano_id)
+            pano = streetview.find_panorama_by_id(pano_id, session=self._get_session())
             if pano is None:
                 logger.warning(f"Failed to find panorama {pano_id}")
                 return None
             
-            # Download the panorama image at highest resolution
-            try:
-                # Get panorama with maximum quality if supported
-                panorama_image = streetview.get_panorama(pano, zoom=5)  # Highest zoom level
-            except:
-                # Fallback to default if zoom parameter not supported
-                panorama_image = streetview.get_panorama(pano)
+            # Download the panorama image at highest resolution (zoom 5, the
+            # same level the async path fetches by default)
+            panorama_image = streetview.get_panorama(pano, zoom=5)
             
             if panorama_image is None:
                 logger.warning(f"Failed to download panorama {pano_id}")
                 return None
             
             # Return the PIL Image directly
-            if isinstance(panorama_image, Image.Image):
-                return panorama_image
-            elif isinstance(panorama_image, np.ndarray):
-                return Image.fromarray(panorama_image)
-            else:
+            if isinstance(panorama_image, np.ndarray):
+                panorama_image = Image.fromarray(panorama_image)
+            elif not isinstance(panorama_image, Image.Image):
                 logger.warning(f"Unexpected panorama image type: {type(panorama_image)}")
                 return None
+            
+            if panorama_image.mode != "RGB":
+                panorama_image = panorama_image.convert("RGB")
+            
+            # streetlevel stitches tiles, so there are no original bytes to keep;
+            # encode the JPEG on a background thread instead of on the request path
+            threading.Thread(
+                target=store_cached_pano, args=(pano_id, pano, np.asarray(panorama_image))
+            ).start()
+            return panorama_image
                 
         except Exception as e:
             logger.error(f"Error fetching panorama {pano_id}: {e}")
             return None
     
-    async def generate_centered_view_for_row(self, row: pd.Series, session: aiohttp.ClientSession,
-                                           output_dir: str = "data/views") -> Optional[Dict[str, Any]]:
+    async def generate_centered_view_for_row(self, row: Mapping[str, Any], session: aiohttp.ClientSession,
+                                           output_dir: str = "data/views",
+                                           pano_tasks: Optional[Dict[Tuple[str, int, int], asyncio.Task]] = None
+                                           ) -> Optional[Dict[str, Any]]:
         """
         Generate a centered view for a specific CSV row.
         
         Args:
-            row: Pandas Series representing a single CSV row
+            row: Pandas Series or dict representing a single CSV row
             session: aiohttp ClientSession for HTTP requests
             output_dir: Directory to save the output
+            pano_tasks: Optional batch-local dict of shared panorama fetch tasks
             
         Returns:
             Dictionary with result information or None if failed
@@ -165,8 +298,11 @@ class PanoramaFetcher:
             
             logger.info(f"🔄 Generating centered view for {pano_id} - {Path(image_path).name}")
             
-            # Fetch panorama data
-            pano, panorama_image = await self.fetch_panorama_async(pano_id, session)
+            # Fetch panorama data, without the oversampled resolution the
+            # 1024x720 view can't show
+            pano, panorama_image, scale = await self.fetch_view_panorama_async(
+                pano_id, session, 1024, 90, pano_tasks
+            )
             
             if pano is None or panorama_image is None:
                 logger.warning(f"⚠️ Failed to fetch panorama: {pano_id}")
@@ -175,19 +311,22 @@ class PanoramaFetcher:
             # Get panorama dimensions
             panorama_height, panorama_width = panorama_image.shape[:2]
             
-            # Create centered view with fixed dimensions 1024x720
-            centered_view = self.create_centered_view(
-                panorama_image, image_x,
+            # Create centered view with fixed dimensions 1024x720 (off the event
+            # loop, so other rows' downloads keep progressing)
+            centered_view = await asyncio.to_thread(
+                self.create_centered_view,
+                panorama_image, image_x * scale,
                 panorama_width, panorama_height,
                 1024, 720, 90
             )
             
-            # Convert BGR to RGB for encoding
+            # Panoramas come from PIL as RGB but cv2.imencode expects BGR, so this
+            # swap is required (COLOR_BGR2RGB and COLOR_RGB2BGR are the same swizzle)
             centered_view_rgb = cv2.cvtColor(centered_view, cv2.COLOR_BGR2RGB)
 
             # Encode image as JPEG bytes (no disk write, no extra deps)
             encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), 85]
-            success, enc = cv2.imencode('.jpg', centered_view_rgb, encode_params)
+            success, enc = await asyncio.to_thread(cv2.imencode, '.jpg', centered_view_rgb, encode_params)
             if not success:
                 logger.error("❌ Failed to JPEG-encode centered view in memory")
                 return None
@@ -212,3 +351,57 @@ class PanoramaFetcher:
         except Exception as e:
             logger.error(f"❌ Error generating centered view for {row.get('image_path', 'unknown')}: {str(e)}")
             return None
+    
+    def create_session(self) -> aiohttp.ClientSession:
+        """
+        Create an aiohttp session whose connection pool matches max_concurrent.
+        
+        Street View hosts are resolved once per 5 minutes rather than aiohttp's
+        default 10 seconds, since a batch keeps hitting the same few hosts.
+        
+        Returns:
+            aiohttp ClientSession for batch fetches (caller closes it)
+        """
+        connector = aiohttp.TCPConnector(limit=self.max_concurrent, limit_per_host=self.max_concurrent,
+                                         ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector)
+    
+    async def _run_with_semaphore(self, semaphore: asyncio.Semaphore, coro):
+        """Await coro once a semaphore slot is free."""
+        async with semaphore:
+            return await coro
+    
+    async def generate_many(self, rows_df: pd.DataFrame,
+                            session: aiohttp.ClientSession) -> List[Optional[Dict[str, Any]]]:
+        """
+        Generate centered views for many CSV rows concurrently.
+        
+        At most max_concurrent rows are processed at once, so downloads overlap
+        without flooding the Street View servers.
+        
+        Args:
+            rows_df: DataFrame of CSV rows to process
+            session: aiohttp ClientSession for HTTP requests
+            
+        Returns:
+            List of results (or None for failed rows) in the order of rows_df
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        
+        # Panorama fetches shared by rows of this batch only, so a panorama with
+        # many trees is downloaded, decoded and downsampled once. Keeping them
+        # local means batches on other threads' event loops never see them.
+        pano_tasks: Dict[Tuple[str, int, int], asyncio.Task] = {}
+        tasks = [
+            self._run_with_semaphore(
+                semaphore,
+                self.generate_centered_view_for_row(row, session, pano_tasks=pano_tasks)
+            )
+            for row in rows_df.to_dict(orient='records')
+        ]
+        
+        results = await asyncio.gather(*tasks)
+        
+        succeeded = sum(result is not None for result in results)
+        logger.info(f"✅ Generated {succeeded}/{len(results)} centered views")
+        return results
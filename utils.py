@@ -1,13 +1,29 @@
 import logging
+import math
 import numpy as np
+import numba
 import cv2
 import asyncio
+import functools
+import json
+import os
+import random
+import threading
 import time
+from pathlib import Path
+from types import SimpleNamespace
 from streetlevel import streetview
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientResponseError
 
 logger = logging.getLogger(__name__)
 
+# Persistent panorama cache (decoded image + metadata per pano_id), LRU by mtime
+PANO_CACHE_DIR = Path("cache/panos")
+PANO_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# Upper bound on a single retry wait in fetch_pano_by_id (seconds)
+RETRY_MAX_DELAY = 30
+
 
 def xyz2lonlat(xyz):
     """
@@ -48,8 +64,8 @@ def map_perspective_point_to_original(x, y, theta, img_shape, height, width, FOV
     """
     Map perspective point to original equirectangular coordinates with logging.
     """
-    logger.debug(f"🔄 Mapping point ({x}, {y}) at θ={theta}° to equirectangular coordinates")
-    logger.debug(f"📏 Image shape: {img_shape}, View dimensions: {width}x{height}")
+    logger.debug("🔄 Mapping point (%s, %s) at θ=%s° to equirectangular coordinates", x, y, theta)
+    logger.debug("📏 Image shape: %s, View dimensions: %sx%s", img_shape, width, height)
     
     try:
         PHI = 0
@@ -60,19 +76,9 @@ def map_perspective_point_to_original(x, y, theta, img_shape, height, width, FOV
         cx = (width - 1) / 2.0
         cy = (height - 1) / 2.0
 
-        # Create camera matrix
-        K = np.array(
-            [
-                [f, 0, cx],
-                [0, f, cy],
-                [0, 0, 1],
-            ],
-            np.float32,
-        )
-
-        # Convert perspective point to normalized coordinates
-        point = np.array([x, y, 1.0], dtype=np.float32)
-        normalized = np.linalg.inv(K) @ point
+        # Convert perspective point to normalized coordinates (K^-1 @ [x, y, 1]
+        # in closed form, since the camera matrix is upper triangular)
+        normalized = np.array([(x - cx) / f, (y - cy) / f, 1.0], dtype=np.float32)
 
         # Calculate rotation matrices
         y_axis = np.array([0.0, 1.0, 0.0], np.float32)
@@ -93,7 +99,7 @@ def map_perspective_point_to_original(x, y, theta, img_shape, height, width, FOV
         eq_x = (lon / (2 * np.pi) + 0.5) * width_src
         eq_y = (lat / np.pi + 0.5) * height_src
 
-        logger.debug(f"✅ Mapped to equirectangular: ({eq_x:.2f}, {eq_y:.2f})")
+        logger.debug("✅ Mapped to equirectangular: (%.2f, %.2f)", eq_x, eq_y)
         
         return (eq_x, eq_y)
         
@@ -101,6 +107,173 @@ def map_perspective_point_to_original(x, y, theta, img_shape, height, width, FOV
         logger.error(f"❌ Error mapping point ({x}, {y}) at θ={theta}°: {str(e)}")
         raise
 
+@functools.lru_cache(maxsize=8)
+def _inverse_intrinsics(FOV, height, width):
+    """
+    Build (and memoize) the inverse camera matrix of a perspective view.
+
+    Parameters:
+    - FOV (int): Field of View in degrees.
+    - height (int): Height of the perspective view.
+    - width (int): Width of the perspective view.
+
+    Returns:
+    - K_inv (np.ndarray): Read-only (3, 3) float32 inverse intrinsics.
+    """
+    f = 0.5 * width * 1 / np.tan(0.5 * FOV / 180.0 * np.pi)
+    cx = (width - 1) / 2.0
+    cy = (height - 1) / 2.0
+    # K = [[f, 0, cx], [0, f, cy], [0, 0, 1]] inverts in closed form
+    K_inv = np.array(
+        [
+            [1 / f, 0, -cx / f],
+            [0, 1 / f, -cy / f],
+            [0, 0, 1],
+        ],
+        np.float32,
+    )
+    K_inv.flags.writeable = False
+    return K_inv
+
+@functools.lru_cache(maxsize=256)
+def _view_to_world_matrix(theta, PHI, height, width, FOV):
+    """
+    Build (and memoize) the matrix taking homogeneous view pixels to 3D rays.
+
+    Every mask of a view shares theta and the fixed view geometry, so the
+    inverse camera matrix and rotation are folded into one cached 3x3 matrix.
+
+    Parameters:
+    - theta (float): Horizontal angle of the view in degrees.
+    - PHI (float): Vertical angle of the view in degrees.
+    - height (int): Height of the perspective view.
+    - width (int): Width of the perspective view.
+    - FOV (int): Field of View in degrees.
+
+    Returns:
+    - M (np.ndarray): Read-only (3, 3) matrix such that xyz = [x, y, 1] @ M.
+    """
+    y_axis = np.array([0.0, 1.0, 0.0], np.float32)
+    x_axis = np.array([1.0, 0.0, 0.0], np.float32)
+    R1, _ = cv2.Rodrigues(y_axis * np.radians(theta))
+    R2, _ = cv2.Rodrigues(np.dot(R1, x_axis) * np.radians(PHI))
+    R = R2 @ R1
+
+    M = _inverse_intrinsics(FOV, height, width).T @ R.T
+    M.flags.writeable = False
+    return M
+
+def map_perspective_points_to_original(points, theta, img_shape, height, width, FOV):
+    """
+    Map an array of perspective points to original equirectangular coordinates.
+
+    Vectorized counterpart of map_perspective_point_to_original: all points
+    share one camera matrix and rotation, so they are mapped in a single pass.
+
+    Parameters:
+    - points (np.ndarray): (N, 2) x/y coordinates in the perspective view.
+    - theta (float): Horizontal angle of the view in degrees.
+    - img_shape (tuple): (width, height) of the equirectangular image.
+    - height (int): Height of the perspective view.
+    - width (int): Width of the perspective view.
+    - FOV (int): Field of View in degrees.
+
+    Returns:
+    - XY (np.ndarray): (N, 2) x/y coordinates on the equirectangular image.
+    """
+    width_src, height_src = img_shape
+
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    homogeneous = np.column_stack([points, np.ones(len(points), np.float32)])
+    xyz = homogeneous @ _view_to_world_matrix(float(theta), 0, height, width, FOV)
+
+    lonlat = xyz2lonlat(xyz)
+    return lonlat2XY(lonlat, width_src, height_src)
+
+@functools.lru_cache(maxsize=4)
+def _view_rays(FOV, height, width):
+    """
+    Build (and memoize) the unrotated camera ray for every pixel of a perspective view.
+
+    The rays depend only on the view geometry, which is fixed across the app,
+    so each new theta only costs one rotation of this table.
+
+    Parameters:
+    - FOV (int): Field of View in degrees.
+    - height (int): Height of the perspective view.
+    - width (int): Width of the perspective view.
+
+    Returns:
+    - rays (np.ndarray): Read-only (height, width, 3) float32 ray directions.
+    """
+    K_inv = _inverse_intrinsics(FOV, height, width)
+
+    x = np.arange(width)
+    y = np.arange(height)
+    x, y = np.meshgrid(x, y)
+    z = np.ones_like(x)
+    rays = (np.stack([x, y, z], axis=-1) @ K_inv.T).astype(np.float32)
+    rays.flags.writeable = False
+    return rays
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _project_rays(rays, R, width_src, height_src, map_x, map_y):
+    """
+    Rotate view rays and project them onto the equirectangular image in one pass.
+
+    Fuses the rotation, xyz2lonlat and lonlat2XY so no intermediate
+    (H, W, 3) or (H, W, 2) arrays are allocated.
+
+    Parameters:
+    - rays (np.ndarray): (H, W, 3) float32 unrotated ray directions.
+    - R (np.ndarray): (3, 3) float32 rotation matrix.
+    - width_src (float): Source image width.
+    - height_src (float): Source image height.
+    - map_x (np.ndarray): (H, W) float32 output x coordinates.
+    - map_y (np.ndarray): (H, W) float32 output y coordinates.
+    """
+    height, width = map_x.shape
+    for i in numba.prange(height):
+        for j in range(width):
+            rx, ry, rz = rays[i, j, 0], rays[i, j, 1], rays[i, j, 2]
+            x = rx * R[0, 0] + ry * R[0, 1] + rz * R[0, 2]
+            y = rx * R[1, 0] + ry * R[1, 1] + rz * R[1, 2]
+            z = rx * R[2, 0] + ry * R[2, 1] + rz * R[2, 2]
+            lon = math.atan2(x, z)
+            lat = math.atan2(y, math.sqrt(x * x + z * z))
+            map_x[i, j] = (lon / (2 * math.pi) + 0.5) * width_src
+            map_y[i, j] = (lat / math.pi + 0.5) * height_src
+
+def get_perspective_maps(FOV, THETA, PHI, height, width, height_src, width_src):
+    """
+    Compute the cv2.remap sample maps for a perspective view of an equirectangular image.
+
+    The maps depend only on the view geometry, not on the image content, so
+    callers can cache them and reuse them across panoramas of the same size.
+
+    Parameters:
+    - FOV (int): Field of View in degrees.
+    - THETA (int): Horizontal angle in degrees.
+    - PHI (int): Vertical angle in degrees.
+    - height (int): Height of the perspective image.
+    - width (int): Width of the perspective image.
+    - height_src (int): Source image height.
+    - width_src (int): Source image width.
+
+    Returns:
+    - (map_x, map_y) (tuple of np.ndarray): float32 source coordinates per output pixel.
+    """
+    y_axis = np.array([0.0, 1.0, 0.0], np.float32)
+    x_axis = np.array([1.0, 0.0, 0.0], np.float32)
+    R1, _ = cv2.Rodrigues(y_axis * np.radians(THETA))
+    R2, _ = cv2.Rodrigues(np.dot(R1, x_axis) * np.radians(PHI))
+    R = np.ascontiguousarray(R2 @ R1, dtype=np.float32)
+
+    map_x = np.empty((height, width), np.float32)
+    map_y = np.empty((height, width), np.float32)
+    _project_rays(_view_rays(FOV, height, width), R, float(width_src), float(height_src), map_x, map_y)
+    return map_x, map_y
+
 def get_perspective(img, FOV, THETA, PHI, height, width, height_src, width_src):
     """
     Extract a perspective view from an equirectangular image.
@@ -118,52 +291,150 @@ def get_perspective(img, FOV, THETA, PHI, height, width, height_src, width_src):
     Returns:
     - persp_img (np.ndarray): The resulting perspective image.
     """
-    logger.debug(f"🎯 Extracting perspective view: θ={THETA}°, φ={PHI}°, FOV={FOV}°")
+    logger.debug("🎯 Extracting perspective view: θ=%s°, φ=%s°, FOV=%s°", THETA, PHI, FOV)
     
+    map_x, map_y = get_perspective_maps(FOV, THETA, PHI, height, width, height_src, width_src)
+    persp_img = cv2.remap(
+        img,
+        map_x,
+        map_y,
+        cv2.INTER_CUBIC,
+        borderMode=cv2.BORDER_WRAP,
+    )
+
+    logger.debug("✅ Perspective view extracted successfully - Output shape: %s", persp_img.shape)
+    return persp_img
+
+def load_cached_pano(pano_id):
+    """
+    Read a panorama from the disk cache shared by the async and sync fetch paths.
+
+    Parameters:
+    - pano_id (str): Panorama ID to look up.
+
+    Returns:
+    - (pano, rgb_array) or None: Metadata (a SimpleNamespace with id, heading,
+      width and height) and the read-only RGB image, or None on a miss.
+    """
+    image_path = PANO_CACHE_DIR / f"{pano_id}.jpg"
+    meta_path = PANO_CACHE_DIR / f"{pano_id}.json"
+    if not (image_path.exists() and meta_path.exists()):
+        return None
     try:
-        f = 0.5 * width * 1 / np.tan(0.5 * FOV / 180.0 * np.pi)
-        cx = (width - 1) / 2.0
-        cy = (height - 1) / 2.0
-        K = np.array(
-            [
-                [f, 0, cx],
-                [0, f, cy],
-                [0, 0, 1],
-            ],
-            np.float32,
-        )
-        K_inv = np.linalg.inv(K)
-
-        x = np.arange(width)
-        y = np.arange(height)
-        x, y = np.meshgrid(x, y)
-        z = np.ones_like(x)
-        xyz = np.stack([x, y, z], axis=-1) @ K_inv.T
+        # cv2.imread decodes with libjpeg-turbo
+        bgr = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+        if bgr is None:
+            return None
+        pano = SimpleNamespace(**json.loads(meta_path.read_bytes()))
+    except Exception as e:
+        logger.warning(f"⚠️ Ignoring unreadable cache entry for {pano_id}: {str(e)}")
+        return None
 
-        y_axis = np.array([0.0, 1.0, 0.0], np.float32)
-        x_axis = np.array([1.0, 0.0, 0.0], np.float32)
-        R1, _ = cv2.Rodrigues(y_axis * np.radians(THETA))
-        R2, _ = cv2.Rodrigues(np.dot(R1, x_axis) * np.radians(PHI))
-        R = R2 @ R1
-        xyz = xyz @ R.T
-
-        lonlat = xyz2lonlat(xyz)
-        XY = lonlat2XY(lonlat, width_src, height_src).astype(np.float32)
-        persp_img = cv2.remap(
-            img,
-            XY[..., 0],
-            XY[..., 1],
-            cv2.INTER_CUBIC,
-            borderMode=cv2.BORDER_WRAP,
-        )
-
-        logger.debug(f"✅ Perspective view extracted successfully - Output shape: {persp_img.shape}")
-        return persp_img
-        
+    # Touch hits so the sweep in evict_pano_cache drops the least recently used
+    # panoramas first; a concurrent sweep may already have removed the file
+    try:
+        os.utime(image_path)
+    except FileNotFoundError:
+        pass
+    logger.info(f"💾 Panorama {pano_id} loaded from disk cache")
+    # Read-only, like the np.asarray view returned by a fresh fetch
+    rgb_array = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    rgb_array.flags.writeable = False
+    return pano, rgb_array
+
+def store_cached_pano(pano_id, pano, rgb_array):
+    """Write a fetched panorama to the disk cache and evict the least recently used."""
+    try:
+        PANO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        image_path = PANO_CACHE_DIR / f"{pano_id}.jpg"
+        meta_path = PANO_CACHE_DIR / f"{pano_id}.json"
+        # Only plain fields are persisted, so reading an entry never runs code
+        meta = {
+            "id": pano.id,
+            "heading": pano.heading,
+            "width": rgb_array.shape[1],
+            "height": rgb_array.shape[0],
+        }
+
+        # cv2 writes BGR; the arrays handled here are RGB
+        success, enc = cv2.imencode('.jpg', cv2.cvtColor(rgb_array, cv2.COLOR_RGB2BGR),
+                                    [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+        if not success:
+            return
+        for path, data in ((meta_path, json.dumps(meta).encode()), (image_path, enc.tobytes())):
+            # Per-process, per-thread name, so concurrent writers of one pano never share a temp file
+            tmp_path = path.with_suffix(path.suffix + f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+        evict_pano_cache()
     except Exception as e:
-        logger.error(f"❌ Error extracting perspective view at θ={THETA}°: {str(e)}")
-        raise
+        logger.warning(f"⚠️ Could not cache panorama {pano_id} on disk: {str(e)}")
+
+def evict_pano_cache(cache_dir=PANO_CACHE_DIR, max_bytes=PANO_CACHE_MAX_BYTES):
+    """
+    Drop the oldest-used JPEGs in a cache directory until it fits its budget.
+
+    Parameters:
+    - cache_dir (Path): Directory of cached *.jpg files (and their sidecars).
+    - max_bytes (int): Total JPEG size to keep.
+    """
+    entries = []
+    for path in cache_dir.glob("*.jpg"):
+        try:
+            entries.append((path.stat(), path))
+        except FileNotFoundError:
+            # Removed by a concurrent sweep
+            continue
+    total = sum(st.st_size for st, _ in entries)
+    for st, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        path.with_suffix(".json").unlink(missing_ok=True)
+        total -= st.st_size
+
+def cached_pano_fetch(fetch):
+    """
+    Add a persistent on-disk LRU cache in front of an async panorama fetch.
+
+    Entries are read and written with load_cached_pano/store_cached_pano, so
+    PanoramaFetcher.fetch_panorama_sync shares them.
+    """
+    @functools.wraps(fetch)
+    async def wrapper(pano_id: str, session: ClientSession, *args, **kwargs):
+        cached = await asyncio.to_thread(load_cached_pano, pano_id)
+        if cached is not None:
+            return cached
+
+        pano, rgb_array = await fetch(pano_id, session, *args, **kwargs)
+        if pano is not None and rgb_array is not None:
+            # Encode on a background thread so the fetch returns without waiting
+            # for the full-resolution JPEG write
+            threading.Thread(target=store_cached_pano, args=(pano_id, pano, rgb_array)).start()
+        return pano, rgb_array
+
+    return wrapper
+
+def _retry_delay(attempt, error=None):
+    """
+    Compute how long to wait before retrying a failed panorama fetch.
+
+    Parameters:
+    - attempt (int): Zero-based index of the attempt that failed.
+    - error (Exception): The failure, checked for a 429/503 Retry-After header.
+
+    Returns:
+    - delay (float): Seconds to sleep, capped at RETRY_MAX_DELAY.
+    """
+    if isinstance(error, ClientResponseError) and error.status in (429, 503) and error.headers:
+        retry_after = error.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), RETRY_MAX_DELAY)
+    # Jitter keeps concurrent failing fetches from retrying in lockstep
+    return min(2 ** attempt + random.random(), RETRY_MAX_DELAY)
 
+@cached_pano_fetch
 async def fetch_pano_by_id(pano_id: str, session: ClientSession, max_retries: int = 3):
     """Fetch panorama by ID with retry logic and optimized networking."""
     logger.info(f"🔍 Fetching panorama: {pano_id}")
@@ -188,7 +459,11 @@ async def fetch_pano_by_id(pano_id: str, session: ClientSession, max_retries: in
             
             # Fetch RGB image with retry
             rgb = await streetview.get_panorama_async(pano, session) 
-            rgb_array = np.array(rgb)
+            if rgb.mode != "RGB":
+                rgb = rgb.convert("RGB")
+            # Wrap PIL's exported buffer instead of copying it again (read-only;
+            # downstream code only reads the panorama)
+            rgb_array = np.asarray(rgb)
             
             fetch_time = time.time() - fetch_start_time
             logger.info(f"✅ Panorama {pano_id} fetched in {fetch_time:.2f}s - Shape: {rgb_array.shape}")
@@ -198,7 +473,7 @@ async def fetch_pano_by_id(pano_id: str, session: ClientSession, max_retries: in
         except asyncio.TimeoutError:
             logger.warning(f"⏰ Timeout fetching {pano_id} (attempt {attempt + 1}/{max_retries})")
             if attempt < max_retries - 1:
-                await asyncio.sleep(1 * (attempt + 1))  # Exponential backoff
+                await asyncio.sleep(_retry_delay(attempt))  # Jittered exponential backoff
                 continue
         except ValueError as e:
             if "invalid literal for int() with base 2" in str(e):
@@ -206,12 +481,12 @@ async def fetch_pano_by_id(pano_id: str, session: ClientSession, max_retries: in
             else:
                 logger.warning(f"❌ ValueError fetching panorama {pano_id} (attempt {attempt + 1}/{max_retries}): {str(e)}")
             if attempt < max_retries - 1:
-                await asyncio.sleep(1 * (attempt + 1))  # Exponential backoff
+                await asyncio.sleep(_retry_delay(attempt))  # Jittered exponential backoff
                 continue
         except Exception as e:
             logger.warning(f"❌ Error fetching panorama {pano_id} (attempt {attempt + 1}/{max_retries}): {str(e)}")
             if attempt < max_retries - 1:
-                await asyncio.sleep(1 * (attempt + 1))  # Exponential backoff
+                await asyncio.sleep(_retry_delay(attempt, e))  # Jittered exponential backoff
                 continue
     
     logger.error(f"❌ Failed to fetch panorama {pano_id} after {max_retries} attempts")